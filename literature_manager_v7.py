@@ -1,10 +1,52 @@
 import re
 import json
+import bisect
 import os
-import webbrowser
+import sys
+import subprocess
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
-from docx import Document
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+
+# 预编译正则
+_DOI_RE = re.compile(r"(10\.\d{4,9}/[-._;()/:A-Za-z0-9]+)")
+_YEAR_RE = re.compile(r"(19\d{2}|20\d{2})")
+# DOI / URL / 页码 / 年份 合并为一次扫描
+_CITATION_RE = re.compile(
+    r"(?P<doi>10\.\d{4,9}/[-._;()/:A-Za-z0-9]+)"
+    r"|(?P<url>https?://[^\s]+)"
+    r"|(?P<pages>\d{1,5}\s*[-–]\s*\d{1,5})"
+    r"|(?P<year>19\d{2}|20\d{2})"
+)
+_APA_RE = re.compile(
+    r"^(?P<authors>.+?)\s*\((?P<year>19\d{2}|20\d{2})\)\.\s*(?P<title>.+?)\.\s*(?P<rest>.+)$"
+)
+_ID_TAG_RE = re.compile(r"\[id:(.*?)\]")
+_AUTHOR_SPLIT_RE = re.compile(r"\s+and\s+|\s+&\s+|[;；]")
+
+
+# ===========================================================
+#                 文献库 TXT（每行一条 JSON）
+# ===========================================================
+def dump_entry(e) -> bytes:
+    # "_" 开头的字段为运行时缓存，不写入文件
+    e = {k: v for k, v in e.items() if not k.startswith("_")}
+    if orjson is not None:
+        return orjson.dumps(e)
+    return json.dumps(e, ensure_ascii=False).encode("utf8")
+
+
+def load_entries(lines):
+    # 拼成一个 JSON 数组一次解析，避免逐行调用
+    data = b"[" + b",".join(lines) + b"]"
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 # ===========================================================
@@ -13,9 +55,7 @@ from docx import Document
 def smart_parse_authors(raw: str):
     if not raw:
         return []
-    s = raw.replace(" and ", " ; ").replace(" & ", " ; ").replace("；", ";")
-
-    parts = [p.strip(" ,.") for p in s.split(";") if p.strip(" ,.")]
+    parts = [p.strip(" ,.") for p in _AUTHOR_SPLIT_RE.split(raw) if p.strip(" ,.")]
     authors = []
     for p in parts:
         if "," in p:      # Reeves, C. R.
@@ -28,6 +68,11 @@ def smart_parse_authors(raw: str):
     return authors
 
 
+# 列表中显示的作者字符串
+def format_authors(authors):
+    return "; ".join([f"{x['family']} {x['given']}" for x in authors])
+
+
 # ===========================================================
 #                 文献自动识别（APA/MLA/GB/T）
 # ===========================================================
@@ -47,26 +92,25 @@ def parse_citation(raw: str):
         "files": []
     }
 
-    # DOI
-    doi = re.search(r"(10\.\d{4,9}/[-._;()/:A-Za-z0-9]+)", text)
-    if doi:
-        result["doi"] = doi.group(1)
+    # DOI / URL / 页码 / 年份（各取首个）
+    found = {}
+    for tok in _CITATION_RE.finditer(text):
+        found.setdefault(tok.lastgroup, tok.group())
+        if len(found) == 4:
+            break
 
-    # URL
-    url = re.search(r"(https?://[^\s]+)", text)
-    if url:
-        result["url"] = url.group(1)
+    # DOI 常嵌在 URL 中：https://doi.org/10.xxxx/...
+    if "doi" not in found and "url" in found:
+        doi = _DOI_RE.search(found["url"])
+        if doi:
+            found["doi"] = doi.group(1)
 
-    # 页码
-    pages = re.search(r"(\d{1,5}\s*[-–]\s*\d{1,5})", text)
-    if pages:
-        result["pages"] = pages.group(1).replace(" ", "")
+    result["doi"] = found.get("doi", "")
+    result["url"] = found.get("url", "")
+    result["pages"] = found.get("pages", "").replace(" ", "")
 
     # APA: Authors (Year). Title. Journal
-    apa = re.compile(
-        r"^(?P<authors>.+?)\s*\((?P<year>19\d{2}|20\d{2})\)\.\s*(?P<title>.+?)\.\s*(?P<rest>.+)$"
-    )
-    m = apa.match(text)
+    m = _APA_RE.match(text)
     if m:
         result["authors"] = smart_parse_authors(m.group("authors"))
         result["year"] = m.group("year")
@@ -81,9 +125,7 @@ def parse_citation(raw: str):
         result["title"] = seg[1]
         if len(seg) >= 3:
             result["journal"] = seg[2]
-        y = re.search(r"(19\d{2}|20\d{2})", text)
-        if y:
-            result["year"] = y.group(1)
+        result["year"] = _first_year(found, text)
         return result
 
     # 逗号回退
@@ -95,16 +137,28 @@ def parse_citation(raw: str):
     if len(parts) >= 3:
         result["journal"] = parts[2]
 
-    year = re.search(r"(19\d{2}|20\d{2})", text)
-    if year:
-        result["year"] = year.group(1)
+    result["year"] = _first_year(found, text)
 
     return result
 
 
+def _first_year(found, text):
+    # 年份可能被页码 / DOI 覆盖，此时回退到全文搜索
+    if "year" in found:
+        return found["year"]
+    y = _YEAR_RE.search(text)
+    return y.group(1) if y else ""
+
+
 # ===========================================================
 #                        DOCX 工具
 # ===========================================================
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P = _W + "p"
+_W_T = _W + "t"
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+
+
 def apa_citation(entry):
     if not entry["authors"]:
         return f"(Unknown, {entry['year']})"
@@ -115,32 +169,82 @@ def apa_citation(entry):
     return f"({entry['authors'][0]['family']} et al., {entry['year']})"
 
 
+def paragraph_text_nodes(p):
+    # 段落自身的 w:t 节点（排除文本框等嵌套段落里的）
+    return [t for t in p.iter(_W_T) if next(t.iterancestors(_W_P)) is p]
+
+
+def sub_text_nodes(ts, text, rep_for):
+    # 在 w:t 节点上原地替换，保留各 run 的格式；标签跨 run 时并入首个节点
+    parts = [t.text or "" for t in ts]
+    starts = []
+    pos = 0
+    for x in parts:
+        starts.append(pos)
+        pos += len(x)
+
+    changed = set()
+    for m in reversed(list(_ID_TAG_RE.finditer(text))):
+        rep = rep_for(m)
+        if rep == m.group(0):
+            continue
+        a = bisect.bisect_right(starts, m.start()) - 1
+        b = bisect.bisect_right(starts, m.end() - 1) - 1
+        if a == b:
+            x = parts[a]
+            parts[a] = x[:m.start() - starts[a]] + rep + x[m.end() - starts[a]:]
+        else:
+            parts[a] = parts[a][:m.start() - starts[a]] + rep
+            for k in range(a + 1, b):
+                parts[k] = ""
+            parts[b] = parts[b][m.end() - starts[b]:]
+            changed.update(range(a + 1, b + 1))
+        changed.add(a)
+
+    for k in changed:
+        ts[k].text = parts[k]
+        ts[k].set(_XML_SPACE, "preserve")
+
+
 def replace_ids(doc, library, style):
     id_map = {}
     counter = 1
 
-    for p in doc.paragraphs:
-        ids = re.findall(r"\[id:(.*?)\]", p.text)
-        for rid in ids:
+    # 直接遍历 XML（含表格内段落）；先用子串判断跳过没有引用的段落
+    cited = []
+    for p in doc.element.body.iter(_W_P):
+        ts = paragraph_text_nodes(p)
+        text = "".join([t.text or "" for t in ts])
+        if "[id:" not in text:
+            continue
+        cited.append((ts, text))
+        for rid in _ID_TAG_RE.findall(text):
             if rid not in id_map:
                 id_map[rid] = counter
                 counter += 1
 
-    for p in doc.paragraphs:
-        for rid, num in id_map.items():
-            entry = next((x for x in library if x["id"] == rid), None)
-            if not entry:
-                continue
-            rep = apa_citation(entry) if style == "APA7" else f"[{num}]"
-            p.text = p.text.replace(f"[id:{rid}]", rep)
+    # 每条引用的替换文本只生成一次
+    by_id = {e["id"]: e for e in library}
+    rep_map = {
+        rid: apa_citation(by_id[rid]) if style == "APA7" else f"[{num}]"
+        for rid, num in id_map.items() if rid in by_id
+    }
+
+    def rep_for(m):
+        return rep_map.get(m.group(1), m.group(0))
+
+    for ts, text in cited:
+        sub_text_nodes(ts, text, rep_for)
 
-    return id_map
+    # 按首次出现顺序编号，字典插入顺序即编号顺序
+    return list(id_map.items())
 
 
-def insert_refs(doc, library, id_map, style):
+def insert_refs(doc, library, cites, style):
     doc.add_heading("References" if style == "APA7" else "参考文献", level=1)
-    for rid, num in sorted(id_map.items(), key=lambda x: x[1]):
-        e = next((x for x in library if x["id"] == rid), None)
+    by_id = {e["id"]: e for e in library}
+    for rid, num in cites:
+        e = by_id.get(rid)
         if not e:
             continue
         line = f"[{num}] {e['title']}. {e['journal']} ({e['year']})."
@@ -161,8 +265,13 @@ class LiteratureManager:
         self.next_id = 1
         self.current_txt_path = None
 
+        # 自动保存：记录改动并延迟合并写盘
+        self._dirty_ids = set()
+        self._save_pending = False
+
         self.build_menubar()
         self.build_layout()
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.window.mainloop()
 
@@ -196,12 +305,16 @@ class LiteratureManager:
 
         # 帮助
         m_help = tk.Menu(menubar, tearoff=0)
-        m_help.add_command(label="AskSpace版权所有,联系我们SpaceAero@163.com", command=lambda: webbrowser.open("http://askspace.cn/wx.html"))
-        m_help.add_command(label="AskSpace.cn 帮助中心", command=lambda: webbrowser.open("http://askspace.cn/wx.html"))
+        m_help.add_command(label="AskSpace版权所有,联系我们SpaceAero@163.com", command=self.open_help)
+        m_help.add_command(label="AskSpace.cn 帮助中心", command=self.open_help)
         menubar.add_cascade(label="帮助", menu=m_help)
 
         self.window.config(menu=menubar)
 
+    def open_help(self):
+        import webbrowser
+        webbrowser.open("http://askspace.cn/wx.html")
+
     # ------------------------ 主布局 ------------------------
     def build_layout(self):
         main = tk.Frame(self.window)
@@ -282,11 +395,18 @@ class LiteratureManager:
         self.log.insert(tk.END, t + "\n")
         self.log.see(tk.END)
 
+    @staticmethod
+    def tree_values(e):
+        return (e["id"], e["_display_authors"], e["title"], e["year"], e["doi"])
+
+    # 整表重建，仅用于加载文献库
     def refresh_tree(self):
         self.tree.delete(*self.tree.get_children())
         for e in self.library:
-            au = "; ".join([f"{x['family']} {x['given']}" for x in e["authors"]])
-            self.tree.insert("", "end", values=(e["id"], au, e["title"], e["year"], e["doi"]))
+            self.tree_insert(e)
+
+    def tree_insert(self, e):
+        self.tree.insert("", "end", values=self.tree_values(e))
 
     def add_entry(self):
         e = {
@@ -301,12 +421,13 @@ class LiteratureManager:
             "doi": "",
             "url": "",
             "raw_text": "",
-            "files": []
+            "files": [],
+            "_display_authors": ""
         }
         self.next_id += 1
         self.library.append(e)
-        self.refresh_tree()
-        self.auto_save()
+        self.tree_insert(e)
+        self.schedule_save(e["id"])
         self.logmsg(f"新建文献：{e['id']}")
 
     def delete_entry(self):
@@ -316,8 +437,8 @@ class LiteratureManager:
         index = self.tree.index(sel[0])
         rid = self.library[index]["id"]
         self.library.pop(index)
-        self.refresh_tree()
-        self.auto_save()
+        self.tree.delete(sel[0])
+        self.schedule_save(rid)
         self.logmsg(f"已删除：{rid}")
 
     def add_from_string(self):
@@ -327,11 +448,12 @@ class LiteratureManager:
 
         e = parse_citation(raw)
         e["id"] = f"ref{self.next_id:03d}"
+        e["_display_authors"] = format_authors(e["authors"])
         self.next_id += 1
 
         self.library.append(e)
-        self.refresh_tree()
-        self.auto_save()
+        self.tree_insert(e)
+        self.schedule_save(e["id"])
         self.logmsg(f"自动识别添加：{e['id']}")
 
     # ======================================================
@@ -407,9 +529,10 @@ class LiteratureManager:
                     giv = " ".join(toks[:-1])
                 authors.append({"family": fam, "given": giv})
         e["authors"] = authors
+        e["_display_authors"] = format_authors(authors)
 
-        self.refresh_tree()
-        self.auto_save()
+        self.tree.item(sel[0], values=self.tree_values(e))
+        self.schedule_save(e["id"])
         self.logmsg(f"已保存修改：{e['id']}")
 
     # ======================================================
@@ -427,9 +550,16 @@ class LiteratureManager:
         if not paths:
             return
 
-        e["files"].extend(list(paths))
-        self.auto_save()
-        self.logmsg(f"已添加附件（{len(paths)} 个）")
+        # 跳过已关联的文件
+        seen = set(e["files"])
+        new_files = [p for p in paths if not (p in seen or seen.add(p))]
+        if not new_files:
+            self.logmsg("所选附件均已关联")
+            return
+
+        e["files"].extend(new_files)
+        self.schedule_save(e["id"])
+        self.logmsg(f"已添加附件（{len(new_files)} 个）")
 
     def open_file_direct(self, path):
         if not os.path.exists(path):
@@ -437,12 +567,11 @@ class LiteratureManager:
             return
 
         try:
-            if os.name == "nt":
+            if sys.platform == "win32":
                 os.startfile(path)
-            elif os.uname().sysname == "Darwin":
-                os.system(f"open '{path}'")
             else:
-                os.system(f"xdg-open '{path}'")
+                opener = "open" if sys.platform == "darwin" else "xdg-open"
+                subprocess.Popen([opener, path])
         except Exception as exc:
             messagebox.showerror("无法打开", f"{exc}")
 
@@ -496,6 +625,17 @@ class LiteratureManager:
     # ======================================================
     #                      TXT 保存
     # ======================================================
+    def schedule_save(self, rid):
+        self._dirty_ids.add(rid)
+        if not self._save_pending:
+            self._save_pending = True
+            self.window.after(500, self.flush_save)
+
+    def flush_save(self):
+        self._save_pending = False
+        if self._dirty_ids:
+            self.auto_save()
+
     def auto_save(self):
         if self.current_txt_path is None:
             path = filedialog.asksaveasfilename(defaultextension=".txt")
@@ -504,10 +644,11 @@ class LiteratureManager:
                 return
             self.current_txt_path = path
 
-        with open(self.current_txt_path, "w", encoding="utf8") as f:
-            for e in self.library:
-                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        payload = b"".join(dump_entry(e) + b"\n" for e in self.library)
+        with open(self.current_txt_path, "wb") as f:
+            f.write(payload)
 
+        self._dirty_ids.clear()
         self.logmsg(f"自动保存：{self.current_txt_path}")
 
     def save_as_txt(self):
@@ -521,11 +662,15 @@ class LiteratureManager:
         path = filedialog.askopenfilename(filetypes=[("TXT", "*.txt")])
         if not path:
             return
-        with open(path, "r", encoding="utf8") as f:
-            self.library = [json.loads(x) for x in f]
+        self.flush_save()
+        with open(path, "rb") as f:
+            raw = f.read()
+        self.library = load_entries([x for x in raw.splitlines() if x.strip()])
+        for e in self.library:
+            e["_display_authors"] = format_authors(e["authors"])
 
         # 修复 next_id
-        self.next_id = max([int(e["id"][3:]) for e in self.library] + [0]) + 1
+        self.next_id = max((int(e["id"][3:]) for e in self.library), default=0) + 1
         self.current_txt_path = path
 
         self.refresh_tree()
@@ -539,9 +684,12 @@ class LiteratureManager:
         if not path:
             return
 
+        # python-docx 依赖 lxml，导入较慢，用到时再加载
+        from docx import Document
+
         doc = Document(path)
-        id_map = replace_ids(doc, self.library, self.current_style)
-        insert_refs(doc, self.library, id_map, self.current_style)
+        cites = replace_ids(doc, self.library, self.current_style)
+        insert_refs(doc, self.library, cites, self.current_style)
 
         out = path.replace(".docx", f"_output_{self.current_style}.docx")
         doc.save(out)
@@ -554,6 +702,11 @@ class LiteratureManager:
         self.current_style = style
         self.logmsg(f"引用格式切换为：{style}")
 
+    # 关闭前写入尚未保存的改动
+    def on_close(self):
+        self.flush_save()
+        self.window.destroy()
+
 
 # ===========================================================
 # 主入口